@@ -10,7 +10,11 @@ Authors: Enzo Picinnoi and Chloe Lawson
 ### Importing libraries
 import serial
 import time
+import threading
+import queue
+import functools
 from contextlib import contextmanager
+from dataclasses import dataclass
 import numpy as np
 import pyvisa
 import os
@@ -19,11 +23,29 @@ from thorlabs_tsi_sdk.tl_camera import TLCameraSDK
 
 #-----------------------------------------------------------------------------------------------------------------------------------------------------------------
 ### General Functions
-@contextmanager
-def initialize_device(port, brate, bsize, par, stopb):
+# Commands which never change are kept already encoded
+_CMD_RUN = b":PULSE0:STATE ON\n"
+_CMD_STOP = b":PULSE0:STATE OFF\n"
+_CMD_RST = b"*RST\n"
+_START_CMD = b"start\n"
+
+# Commands which take longer than the default timeout of the port to be answered, their responses are waited for longer
+_SLOW_CMDS = (b"*RST", b"*SAV", b"*RCL")
+_SLOW_TIMEOUT = 1.5
+
+# Lines sent by the Arduino which do not hold TDC results
+_SKIP = frozenset((b"", b"start", b"\r\n", b"a"))
+
+# Serial connections are opened once per port and reused by every command() call, so that configuring
+# a device does not pay the port open/close cost for each individual command
+_PORT_CACHE = {}
+_PORT_LOCKS = {}
+_CACHE_LOCK = threading.Lock()
+
+def get_device(port, brate, bsize, par, stopb, timeout = 0.2, write_timeout = 0.5, inter_byte_timeout = 0.05):
     """
     DESCRIPTION:
-        Stablishes communication with a device and closes the conection before finishing
+        Returns the open connection to the device in the given port, stablishing it the first time the port is used
             
     PARAMETERS:
         port(string): Port in which the device is connected in the format of "COM##"
@@ -38,18 +60,143 @@ def initialize_device(port, brate, bsize, par, stopb):
         
         stopb: Stopbits, need to use the serial library variables
                                 accepts: serial.STOPBITS_ONE, serial.STOPBITS_ONE_POINT_FIVE, serial.STOPBITS_TWO
+        
+        timeout (optional): Time in seconds to wait for a response, default is 0.2 which is enough for a short 
+                                response at 115200 baud
+        
+        write_timeout (optional): Time in seconds to wait for a write to finish, default is 0.5
+        
+        inter_byte_timeout (optional): Maximum time in seconds between two received bytes, default is 0.05
     
+    RETURNS:
+        device: the cached serial.Serial connection of the port
+    """
+    with _CACHE_LOCK:
+        device = _PORT_CACHE.get(port)
+        if device is None or not device.is_open:
+            device = serial.Serial(port = port, baudrate=brate, bytesize=bsize, parity=par, stopbits=stopb, timeout = timeout, 
+                                   write_timeout = write_timeout, inter_byte_timeout = inter_byte_timeout)
+            _PORT_CACHE[port] = device
+            _PORT_LOCKS.setdefault(port, threading.RLock())
+    return device
+
+def close_all():
+    """
+    DESCRIPTION:
+        Closes the connection to every device opened with get_device
+        
+    PARAMETERS:
+        None
+        
+    RETURNS:
+        None
+    """
+    with _CACHE_LOCK:
+        for port, device in _PORT_CACHE.items():
+            with _PORT_LOCKS[port]:
+                device.close()
+        _PORT_CACHE.clear()
+
+@contextmanager
+def serial_session():
+    """
+    DESCRIPTION:
+        Keeps the device connections open for the duration of the with-block and closes all of them before finishing
+        
+    PARAMETERS:
+        None
+        
     RETURNS:
         None
     """
-    
-    device = serial.Serial(port = port, baudrate=brate, bytesize=bsize, parity=par, stopbits=stopb, timeout = 1.5)
     try:
-        yield device
+        yield
     finally:
-        device.close()
+        close_all()
+    
+class _port_request:
+    def __init__(self, func, args):
+        """
+        Function call waiting to be run by the worker thread of a port
+        
+        CLASS ELEMENTS:
+            func: function to be called
+            
+            args(tuple): arguments of the function
+        """
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+    
+    def wait(self):
+        """
+        DESCRIPTION:
+            Waits until the worker thread has run the function
+            
+        PARAMETERS:
+            None
+            
+        RETURNS:
+            result: the value returned by the function, the exception is raised again if the function failed
+        """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+# Each port has a worker thread which runs its serial calls in order, the serial reads release the GIL so the 
+# workers of different devices run at the same time
+_PORT_QUEUES = {}
+
+def _port_worker(jobs):
+    """
+    DESCRIPTION:
+        Runs the requests queued for a port one after the other, forever (the thread is a daemon)
+        
+    PARAMETERS:
+        jobs(queue.Queue): queue of _port_request of the port
+        
+    RETURNS:
+        None
+    """
+    while True:
+        request = jobs.get()
+        try:
+            request.result = request.func(*request.args)
+        except Exception as e:
+            request.error = e
+        finally:
+            request.done.set()
+
+def _submit(port, func, *args):
+    """
+    DESCRIPTION:
+        Queues a function call to the worker thread of the port, starting the thread the first time the port is used
+        
+    PARAMETERS:
+        port(string): Port in which the device is connected in the format of "COM##"
+        
+        func: function to be called
+        
+        args: arguments of the function
+        
+    RETURNS:
+        request: _port_request of the call
+    """
+    with _CACHE_LOCK:
+        jobs = _PORT_QUEUES.get(port)
+        if jobs is None:
+            jobs = queue.Queue()
+            threading.Thread(target = _port_worker, args = (jobs,), daemon = True).start()
+            _PORT_QUEUES[port] = jobs
     
-def command(port, command, brate, bsize, par, stopb, repeat = False, good_response = b"ok\r\n"):
+    request = _port_request(func, args)
+    jobs.put(request)
+    return request
+
+def command(port, command, brate, bsize, par, stopb, repeat = False, good_response = b"ok\r\n", max_retries = 3, expect = None, eol = b"\r\n", timeout = None):
     """
     DESCRIPTION:
         Sends the input serial command to the device connected to the specified port
@@ -57,7 +204,7 @@ def command(port, command, brate, bsize, par, stopb, repeat = False, good_respon
     PAARAMETERS:
         port(string): Port in which the device is connected in the format of "COM##"
         
-        command(str): The command which you wuld like to send to the device 
+        command(str or bytes): The command which you wuld like to send to the device 
         
         brate(optional int): Baud rate of the connected device defaults to 115200
         
@@ -74,21 +221,224 @@ def command(port, command, brate, bsize, par, stopb, repeat = False, good_respon
         
         good_response (optional): Expected response if successfull, default is b"ok\r\n"
         
+        max_retries (optional): Maximum number of times the command is sent when repeat is True, default is 3
+        
+        expect (optional): Function which receives the response and returns True if it is valid, 
+                                defaults to comparing the response with good_response
+        
+        eol (optional): Characters which end the response of the device, default is b"\r\n"
+        
+        timeout (optional): Time in seconds to wait for the response, defaults to the timeout of the port (0.2s) or 1.5s 
+                                for the slow commands (*RST, *SAV, *RCL)
+        
     RETURNS:
         res: the response from the device
     """
-    with initialize_device(port, brate, bsize, par, stopb) as device: 
-        while True:
-            device.write(str.encode(command)) # Sending the command
-            res = device.readline() # Reading response
-            if res == good_response: # Checking if the response is what we want
-                repeat = False
-                
-            if not repeat: # Breaking the loop
+    request = _submit(port, _run_command, port, command, brate, bsize, par, stopb, repeat, good_response, max_retries, expect, eol, timeout)
+    return request.wait()
+
+def _run_command(port, command, brate, bsize, par, stopb, repeat, good_response, max_retries, expect, eol, timeout):
+    """
+    DESCRIPTION:
+        Sends the command and reads the response, see command. Runs in the worker thread of the port
+    """
+    if expect is None:
+        expect = lambda res: res == good_response
+    
+    payload = command if isinstance(command, (bytes, bytearray)) else command.encode()
+    
+    device = get_device(port, brate, bsize, par, stopb)
+    res = b""
+    with _PORT_LOCKS[port], _read_timeout(device, [payload], timeout):
+        for attempt in range(max_retries if repeat else 1):
+            if attempt > 0: # The response of the previous attempt may still be arriving
+                _drain(device, 0 if res.endswith(eol) else 1, eol)
+            device.reset_input_buffer() # Discarding any late response so it is not read as the answer to this command
+            device.write(payload) # Sending the command
+            res = device.read_until(eol) # Reading response
+            if expect(res): # Checking if the response is what we want
                 break
-        pass
     return res
 
+def _drain(device, outstanding, eol):
+    """
+    DESCRIPTION:
+        Waits for the responses of a failed attempt which have not arrived yet and discards them together with anything 
+        else left in the input, so that they are not read as the responses to the commands sent again
+        
+    PARAMETERS:
+        device: open serial connection
+        
+        outstanding(int): number of responses which did not arrive before the timeout
+        
+        eol(bytes): Characters which end each response
+        
+    RETURNS:
+        None
+    """
+    if outstanding:
+        with _read_timeout(device, [], max(device.timeout or 0, _SLOW_TIMEOUT)):
+            _read_responses(device, outstanding, eol, 0)
+    device.reset_input_buffer()
+
+@contextmanager
+def _read_timeout(device, payloads, timeout):
+    """
+    DESCRIPTION:
+        Changes the read timeout of the device for the duration of the with-block, when a timeout is given or one of the 
+        commands is slow to be answered (see _SLOW_CMDS), and sets the timeout of the port back at the end
+        
+    PARAMETERS:
+        device: open serial connection
+        
+        payloads(list of bytes): commands which will be sent
+        
+        timeout(float or None): Time in seconds to wait for the responses, None to use the timeout of the port
+        
+    RETURNS:
+        None
+    """
+    if timeout is None and any(payload.startswith(_SLOW_CMDS) for payload in payloads):
+        timeout = _SLOW_TIMEOUT
+    
+    if timeout is None:
+        yield
+        return
+    
+    port_timeout = device.timeout
+    device.timeout = timeout
+    try:
+        yield
+    finally:
+        device.timeout = port_timeout
+
+def _read_responses(device, n, eol, size_hint):
+    """
+    DESCRIPTION:
+        Reads n responses from the device, draining the expected number of bytes in a single read and only reading 
+        response by response when they are longer or shorter than expected
+        
+    PARAMETERS:
+        device: open serial connection
+        
+        n(int): number of responses to read
+        
+        eol(bytes): Characters which end each response
+        
+        size_hint(int): expected total size in bytes of the n responses
+        
+    RETURNS:
+        responses: list with the n responses, b"" for the ones which did not arrive before the timeout
+    """
+    parts = device.read(size_hint).split(eol)
+    responses = [part + eol for part in parts[:-1]][:n]
+    rest = parts[-1] # Incomplete response left at the end of the read
+    
+    while len(responses) < n:
+        # Completing the response left by the read, if the read split the end characters only the missing ones are waited for
+        end = next((eol[k:] for k in range(len(eol) - 1, 0, -1) if rest.endswith(eol[:k])), eol)
+        res = rest + device.read_until(end)
+        rest = b""
+        
+        responses.append(res)
+        if not res.endswith(eol): # The device stopped answering
+            break
+    
+    responses += [b""] * (n - len(responses))
+    return responses
+
+def pipeline(port, commands, brate, bsize, par, stopb, repeat = False, good_response = b"ok\r\n", max_retries = 3, expect = None, eol = b"\r\n", timeout = None):
+    """
+    DESCRIPTION:
+        Sends a list of serial commands to the device connected to the specified port in a single write and then reads
+        one response per command, instead of waiting for each response before sending the next command
+        
+    PARAMETERS:
+        port(string): Port in which the device is connected in the format of "COM##"
+        
+        commands(list of str or bytes): The commands which you would like to send to the device, in order
+        
+        brate(optional int): Baud rate of the connected device defaults to 115200
+        
+        bsize: bytesize, need to use the serial library variables
+                                accepts: serial.EIGHTBITS, serial.SEVENBITS, serial.SIXBITS. serial.FIVEBITS
+        
+        par: Parity,need to use the serial library variables
+                                accepts: serial.PARITY_NONE, serial.PARITY_EVEN, serial.PARITY_ODD, serial.PARITY_MARK, serial.PARITY_SPACE
+        
+        stopb: Stopbits, need to use the serial library variables
+                                accepts: serial.STOPBITS_ONE, serial.STOPBITS_ONE_POINT_FIVE, serial.STOPBITS_TWO
+                                
+        repeat (optional): Repeat the commands from the first one which did not return the good response, default is False
+        
+        good_response (optional): Expected response if successfull, default is b"ok\r\n"
+        
+        max_retries (optional): Maximum number of times a command is sent when repeat is True, default is 3
+        
+        expect (optional): Function which receives a response and returns True if it is valid, 
+                                defaults to comparing the response with good_response
+        
+        eol (optional): Characters which end each response of the device, default is b"\r\n"
+        
+        timeout (optional): Time in seconds to wait for the responses, defaults to the timeout of the port (0.2s) or 1.5s 
+                                for the slow commands (*RST, *SAV, *RCL)
+        
+    RETURNS:
+        responses: list with the response from the device to each command
+    """
+    request = submit(port, commands, brate, bsize, par, stopb, repeat, good_response, max_retries, expect, eol, timeout)
+    return request.wait()
+
+def submit(port, commands, brate, bsize, par, stopb, repeat = False, good_response = b"ok\r\n", max_retries = 3, expect = None, eol = b"\r\n", timeout = None):
+    """
+    DESCRIPTION:
+        Queues a list of serial commands to be pipelined to the device by the worker thread of the port and returns 
+        without waiting, so that several devices can be configured at the same time
+        
+    PARAMETERS:
+        Same as pipeline
+        
+    RETURNS:
+        request: call request.wait() to wait for the commands and get the list of responses
+    """
+    request = _submit(port, _run_pipeline, port, commands, brate, bsize, par, stopb, repeat, good_response, max_retries, expect, eol, timeout)
+    return request
+
+def _run_pipeline(port, commands, brate, bsize, par, stopb, repeat, good_response, max_retries, expect, eol, timeout):
+    """
+    DESCRIPTION:
+        Sends the commands and reads the responses, see pipeline. Runs in the worker thread of the port
+    """
+    if expect is None:
+        expect = lambda res: res == good_response
+    
+    payloads = [cmd if isinstance(cmd, (bytes, bytearray)) else cmd.encode() for cmd in commands]
+    
+    device = get_device(port, brate, bsize, par, stopb)
+    responses = [b""] * len(commands)
+    pending = list(range(len(commands)))
+    outstanding = 0 # Responses of the previous attempt which did not arrive before the timeout
+    with _PORT_LOCKS[port], _read_timeout(device, payloads, timeout):
+        for attempt in range(max_retries if repeat else 1):
+            if attempt > 0: # The responses of the previous attempt may still be arriving
+                _drain(device, outstanding, eol)
+            device.reset_input_buffer() # Discarding any late response so it is not read as the answer to these commands
+            device.write(b"".join(payloads[i] for i in pending)) # Sending all the commands at once
+            # Reading the responses in the order the commands were sent, the size of all of them is only known in advance 
+            # when the good response is a complete response
+            size_hint = len(good_response) * len(pending) if good_response.endswith(eol) else 0
+            for i, res in zip(pending, _read_responses(device, len(pending), eol, size_hint)):
+                responses[i] = res
+            
+            failed = [i for i in pending if not expect(responses[i])]
+            if not failed: # Breaking the loop
+                break
+            outstanding = sum(not responses[i].endswith(eol) for i in pending) # Responses which timed out
+            # The commands are sent again from the first one which failed, so a command (e.g. a reset) is never 
+            # repeated after the ones which followed it
+            pending = pending[pending.index(failed[0]):]
+    return responses
+
 def get_file_name(set_delay, true_delay):
     """
     DESCRIPTION:
@@ -102,15 +452,57 @@ def get_file_name(set_delay, true_delay):
     RETURNS:
         filename: name of the file to be used
     """
-    date = round(time.time())
-    
-    filename = str(date) + "_" + f"{set_delay:09d}" + "_" + f"{true_delay:09d}"
+    filename = f"{round(time.time())}_{set_delay:09d}_{true_delay:09d}"
     
     return filename
 
+def _raise_errors(errors):
+    """
+    DESCRIPTION:
+        Raises a RuntimeError listing the pulse generator settings which failed, if any
+        
+    PARAMETERS:
+        errors(list): (command, response or exception) pairs of the failed commands
+    
+    RETURNS:
+        None
+    """
+    if errors:
+        raise RuntimeError("Pulse Generator settings failed: " + ", ".join(f"{(cmd.decode() if isinstance(cmd, bytes) else cmd).strip()} -> {res!r}" 
+                                                                          for cmd, res in errors))
+
 #-----------------------------------------------------------------------------------------------------------------------------------------------------------------
 ### Class definition and functions for pulse Generator
+@functools.lru_cache(maxsize=1024)
+def _compute_starts(flash_delay, skip_num):
+    """
+    DESCRIPTION:
+        Calculates the time at which the pedal pulses and the flashlamp must start, the results are cached since delay scans
+        repeat the same values
+        
+    PARAMETERS:
+        flash_delay(float): Ideal time between the laser shot and the flashlamp in seconds
+        
+        skip_num(int): Number of pulses to skip before sending the first pedal 
+        
+    RETURNS:
+        (pulse1_start, pulse2_start, flash_start): start times in seconds of the first pedal, second pedal and flashlamp
+    """
+    period = 0.00099997090 # Period of the PILR Laser
+    pedal_delay = 0.00020844 # Time prior to the actual pulse, which the pedal must be sent
+    
+    # The values are rounded to the 11th digit, since that is the precision of the Pulse Generator
+    pulse1_start = round(skip_num * period - pedal_delay - 0.000005 , 11)
+    pulse2_start = round((skip_num * period - pedal_delay - 0.000005) + period, 11) + 2*10**(-6)
+
+    flash_start = round((skip_num + 1) * period + flash_delay, 11)
+    
+    return pulse1_start, pulse2_start, flash_start
+
 class pulse_generator:
+    _CH_IDX = {"A": "1", "B": "2", "C": "3", "D": "4"} # Number of each channel in the commands
+    _prefix = {ch: ":PULSE" + idx for ch, idx in _CH_IDX.items()} # Command prefix of each channel
+    
     def __init__(self, port, baud_rate, bit_size, parity, stop_bits):
         """        
         Class for the Quantum Composers Pulse Generator Series 9520
@@ -138,6 +530,11 @@ class pulse_generator:
         self.parity = parity
         self.stop_bits = stop_bits
         self.bit_size = bit_size
+        self._serial_kwargs = dict(brate = baud_rate, bsize = bit_size, par = parity, stopb = stop_bits) # Arguments of every command call
+        
+        # The settings commands are sent by the worker thread of the port so that the caller does not wait for the responses,
+        # the requests are kept to be checked by sync
+        self._pending = []
 
     def run(self):
         """
@@ -150,7 +547,8 @@ class pulse_generator:
         RETURNS:
             res: Response from the Pulse generator
         """
-        res = command(self.port, ":PULSE0:STATE ON\n", brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
+        self.sync() # The settings must be applied before starting
+        res = command(self.port, _CMD_RUN, **self._serial_kwargs)
         return res
 
     def stop(self):
@@ -164,7 +562,7 @@ class pulse_generator:
         RETURNS:
             res: Response from the Pulse generator
         """        
-        res = command(self.port, ":PULSE0:STATE OFF\n", brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
+        res = command(self.port, _CMD_STOP, **self._serial_kwargs)
         return res
     
     def reset(self):
@@ -178,9 +576,91 @@ class pulse_generator:
         RETURNS:
             res: Response from the Pulse generator
         """
-        res = command(self.port, "*RST\n", brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
+        res = command(self.port, _CMD_RST, **self._serial_kwargs)
         return res
 
+    def _pipeline(self, cmds):
+        """
+        DESCRIPTION:
+            Sends a list of settings commands to the Pulse Generator in a single write, repeating them from the first one which fails
+            
+        PARAMETERS:
+            cmds(list of str): commands to be sent, in order
+        
+        RETURNS:
+            responses: list with the response from the Pulse generator to each command
+        """
+        responses = pipeline(self.port, cmds, repeat = True, **self._serial_kwargs)
+        return responses
+
+    def _send(self, cmds):
+        """
+        DESCRIPTION:
+            Queues a list of settings commands to be sent to the Pulse Generator by the worker thread of the port, without 
+            waiting for the responses
+            
+        PARAMETERS:
+            cmds(list of str): commands to be sent, in order
+        
+        RETURNS:
+            None
+        """
+        request = submit(self.port, cmds, repeat = True, **self._serial_kwargs)
+        self._pending.append((cmds, request))
+
+    def sync(self):
+        """
+        DESCRIPTION:
+            Waits until all the queued settings have been sent to the Pulse Generator
+            
+        PARAMETERS:
+            None
+        
+        RETURNS:
+            None, raises a RuntimeError with the failed commands if any setting did not return b"ok\r\n"
+        """
+        pending, self._pending = self._pending, []
+        
+        errors = []
+        for cmds, request in pending:
+            try:
+                responses = request.wait()
+                errors += [(cmd, res) for cmd, res in zip(cmds, responses) if res != b"ok\r\n"]
+            except Exception as e:
+                errors += [(cmd, e) for cmd in cmds]
+        
+        _raise_errors(errors)
+
+    def channel_cmds(self, channel, delay, width, amp = 3, mode = "TTL" ,ref = "T0", cmode = "SINGLE", enable = True):
+        """
+        DESCRIPTION:
+            Builds the commands which set all of the individual parameters of the specified channel, without sending them
+        
+        PARAMETERS:
+            Same as set_channel
+        
+        RETURNS:
+            cmds: list with the encoded commands, in order
+        """
+        p = self._prefix[channel] # Command prefix of the channel
+        
+        if ref != "T0":
+            ref = "CH" + ref
+        
+        cmds = [f"{p}:SYNC {ref}\n",
+                f"{p}:CMODE {cmode}\n",
+                f"{p}:OUTPUT:AMPLITUDE {amp}V\n",
+                f"{p}:DELAY {delay}\n",
+                f"{p}:WIDTH {width}\n",
+                f"{p}:OUTPUT:MODE {mode}\n"]
+        
+        if enable:
+            cmds.append(f"{p}:STATE ON\n")
+        else:
+            cmds.append(f"{p}:STATE OFF\n")
+        
+        return [cmd.encode() for cmd in cmds]
+
     def set_channel(self, channel, delay, width, amp = 3, mode = "TTL" ,ref = "T0", cmode = "SINGLE", enable = True):
         """
         DESCRIPTION:
@@ -212,31 +692,10 @@ class pulse_generator:
             enable (optional): If True the channel will be enabled at the end of the settings, defaults to True
         
         RETURNS:
-            True, if all settings are successfull
+            True, once all settings are queued (they are checked by sync, which run calls before starting)
 
         """
-        # Converting the imputs to String
-        channel_str = str(ord(channel) - 64)
-        delay_str = str(delay)
-        width_str = str(width)
-        amp_str = str(amp)
-        
-        
-        if ref != "T0":
-            ref = "CH" + ref
-        
-        command(self.port, ":PULSE" + channel_str + ":SYNC " + ref + "\n", repeat = True, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
-        command(self.port, ":PULSE" + channel_str + ":CMODE "+ cmode +"\n", repeat = True, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
-        command(self.port, ":PULSE" + channel_str + ":OUTPUT:AMPLITUDE " + amp_str + "V\n", repeat = True, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
-        command(self.port, ":PULSE" + channel_str + ":DELAY " + delay_str + "\n", repeat = True, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
-        command(self.port, ":PULSE" + channel_str + ":WIDTH " + width_str + "\n", repeat = True, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
-        command(self.port, ":PULSE" + channel_str + ":OUTPUT:MODE " + mode + "\n", repeat = True, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
-        
-        if enable:
-            command(self.port, ":PULSE" + channel_str + ":STATE ON\n", repeat = True, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
-        else:
-            command(self.port, ":PULSE" + channel_str +":STATE OFF\n", repeat = True, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
-        
+        self._send(self.channel_cmds(channel, delay, width, amp, mode, ref, cmode, enable))
         return True
 
         
@@ -253,24 +712,16 @@ class pulse_generator:
             width(float): Width of the pedal pulses in seconds with the smallest possible decimal being nanoseconds
             
         RETURNS:
-            None
+            None, raises a RuntimeError with the failed commands if any setting did not return b"ok\r\n"
         """
-        period = 0.00099997090 # Period of the PILR Laser
-        pedal_delay = 0.00020844 # Time prior to the actual pulse, which the pedal must be sent
+        pulse1_start, pulse2_start, flash_start = _compute_starts(flash_delay, skip_num)
         
-        # The values are rounded to the 11th digit, since that is the precision of the Pulse Generator
-        pulse1_start = round(skip_num * period - pedal_delay - 0.000005 , 11)
-        pulse2_start = round((skip_num * period - pedal_delay - 0.000005) + period, 11) + 2*10**(-6)
-    
-
-        flash_start = round((skip_num + 1) * period + flash_delay, 11)
-        
-        self.reset()
-        self.set_trigger(level = 0.5)
-        self.set_channel(channel = "C", delay = 0.0, width = 0.0005) # Cam
-        self.set_channel(channel = "A", delay = pulse1_start , width= width1) # P1 
-        self.set_channel(channel = "B", delay = pulse2_start, width= width2) # P2 
-        self.set_channel(channel = "D", delay =  flash_start, width = 0.000008) # Flash
+        self.apply(self.reset_cmds() 
+                   + self.trigger_cmds(level = 0.5)
+                   + self.channel_cmds(channel = "C", delay = 0.0, width = 0.0005) # Cam
+                   + self.channel_cmds(channel = "A", delay = pulse1_start , width= width1) # P1 
+                   + self.channel_cmds(channel = "B", delay = pulse2_start, width= width2) # P2 
+                   + self.channel_cmds(channel = "D", delay =  flash_start, width = 0.000008)) # Flash
   
     def set_trigger(self, level, edge = "RISING"):
         """
@@ -287,15 +738,9 @@ class pulse_generator:
                                     "RISING" or "FALLING", default to "RISING"
             
         RETURNS:
-            True if sucessfull
+            True, once all settings are queued (they are checked by sync, which run calls before starting)
         """
-        # Converting the input to String
-        level_str = str(level)
-        
-        command(self.port,":PULSE0:TRIG:MODE TRIG\n", repeat = True, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
-        command(self.port,":PULSE0:TRIGGER:LEVEL " + level_str + "\n", repeat = True, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
-        command(self.port,":PULSE0:TRIGGER:EDGE " + edge + "\n", repeat = True, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
-
+        self._send(self.trigger_cmds(level, edge))
         return True
         
     def set_gate(self, level, logic = "HIGH"):
@@ -311,20 +756,85 @@ class pulse_generator:
                                     "HIGH" or "LOW", default to "HIGH"
             
         RETURNS:
-            True if sucessfull
+            True, once all settings are queued (they are checked by sync, which run calls before starting)
+        """
+        self._send(self.gate_cmds(level, logic))
+        return True
+
+    def trigger_cmds(self, level, edge = "RISING"):
+        """
+        DESCRIPTION:
+            Builds the commands which set the pulse generator to trigger mode with the trigger parameters, without sending them
+            
+        PARAMETERS:
+            Same as set_trigger
+            
+        RETURNS:
+            cmds: list with the encoded commands, in order
         """
         # Converting the input to String
         level_str = str(level)
         
-        command(self.port,":PULSE0:GATE:MODE PULSE\n", repeat = True, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
-        command(self.port,":PULSE0:GATE:LEVEL " + level_str + "\n", repeat = True, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
-        command(self.port,":PULSE0:GATE:LOGIC " + logic + "\n", repeat = True, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
-
-        return True 
+        cmds = [b":PULSE0:TRIG:MODE TRIG\n",
+                (":PULSE0:TRIGGER:LEVEL " + level_str + "\n").encode(),
+                (":PULSE0:TRIGGER:EDGE " + edge + "\n").encode()]
+        return cmds
+    
+    def gate_cmds(self, level, logic = "HIGH"):
+        """
+        DESCRIPTION:
+            Builds the commands which set the pulse generator to gate mode with the gate parameters, without sending them
+            
+        PARAMETERS:
+            Same as set_gate
+            
+        RETURNS:
+            cmds: list with the encoded commands, in order
+        """
+        # Converting the input to String
+        level_str = str(level)
+        
+        cmds = [b":PULSE0:GATE:MODE PULSE\n",
+                (":PULSE0:GATE:LEVEL " + level_str + "\n").encode(),
+                (":PULSE0:GATE:LOGIC " + logic + "\n").encode()]
+        return cmds
+    
+    def reset_cmds(self):
+        """
+        DESCRIPTION:
+            Builds the command which resets the Pulse Generator, without sending it
+            
+        PARAMETERS:
+            None
+            
+        RETURNS:
+            cmds: list with the encoded command
+        """
+        return [_CMD_RST]
+    
+    def apply(self, cmds):
+        """
+        DESCRIPTION:
+            Sends a list of commands built by the *_cmds functions to the Pulse Generator as a single transaction, one write 
+            for all the commands and one read for all the responses
+            
+        PARAMETERS:
+            cmds(list of bytes): commands to be sent, in order
+            
+        RETURNS:
+            responses: list with the response from the Pulse generator to each command, raises a RuntimeError with the failed 
+                        commands if any of them did not return b"ok\r\n"
+        """
+        responses = self._pipeline(cmds) # The worker of the port runs it after the queued settings, so the order is kept
+        _raise_errors([(cmd, res) for cmd, res in zip(cmds, responses) if res != b"ok\r\n"])
+        return responses
 
 #-----------------------------------------------------------------------------------------------------------------------------------------------------------------
 # Class definition and functions for pulse Generator BNC 505
 class BNC_505:
+    _CH_IDX = {1: "1", 2: "2"} # Number of each channel in the commands
+    _prefix = {ch: ":PULSE" + idx for ch, idx in _CH_IDX.items()} # Command prefix of each channel
+    
     def __init__(self, port, baud_rate, bit_size, parity, stop_bits):
         """    
         class for the Berkely Nucleonics Corporation model 505 pulse generator
@@ -352,6 +862,7 @@ class BNC_505:
         self.parity = parity
         self.stop_bits = stop_bits
         self.bit_size = bit_size
+        self._serial_kwargs = dict(brate = baud_rate, bsize = bit_size, par = parity, stopb = stop_bits) # Arguments of every command call
         return 
     
     def run(self):
@@ -365,7 +876,7 @@ class BNC_505:
         RETURNS:
             res: response from the pulse generator
         """
-        res = command(self.port, ":PULSE0:STATE ON\n", brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
+        res = command(self.port, _CMD_RUN, **self._serial_kwargs)
         return res
         
     def stop(self):
@@ -379,7 +890,7 @@ class BNC_505:
         RETURNS:
             res: response from the pulse generator
         """        
-        res = command(self.port, ":PULSE0:STATE OFF\n", brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
+        res = command(self.port, _CMD_STOP, **self._serial_kwargs)
         return res
     
     def reset(self):
@@ -393,9 +904,25 @@ class BNC_505:
         RETURNS:
             res: response from the pulse generator
         """
-        res = command(self.port, "*RST\n", brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
+        res = command(self.port, _CMD_RST, **self._serial_kwargs)
         return res
 
+    def _pipeline(self, cmds):
+        """
+        DESCRIPTION:
+            Sends a list of settings commands to the Pulse Generator in a single write, repeating them from the first one which fails
+            
+        PARAMETERS:
+            cmds(list of str): commands to be sent, in order
+        
+        RETURNS:
+            responses: list with the response from the pulse generator to each command, raises a RuntimeError with the 
+                        failed commands if any of them did not return b"ok\r\n"
+        """
+        responses = pipeline(self.port, cmds, repeat = True, **self._serial_kwargs)
+        _raise_errors([(cmd, res) for cmd, res in zip(cmds, responses) if res != b"ok\r\n"])
+        return responses
+
     def save(self, mem = 1):
         """
         DESCRIPTION:
@@ -408,7 +935,7 @@ class BNC_505:
             res: response from the pulse generator
         """
         mem_str = str(mem)
-        res = command(self.port, "*SAV " + mem_str + "\r\n", brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
+        res = command(self.port, "*SAV " + mem_str + "\r\n", **self._serial_kwargs)
         return res
     
     def recall(self, mem = 1):
@@ -423,7 +950,7 @@ class BNC_505:
             res: response from the pulse generator
         """
         mem_str = str(mem)
-        res = command(self.port, "*RCL " + mem_str + "\n", brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
+        res = command(self.port, "*RCL " + mem_str + "\n", **self._serial_kwargs)
         return res
     
     def set_trigger(self, level, edge = "RISING"):
@@ -439,14 +966,14 @@ class BNC_505:
                                     "RISING" or "FALLING", default to "RISING"
             
         RETURNS:
-            True if reaches the end 
+            True once all the settings are acknowledged, raises a RuntimeError with the failed commands otherwise
         """
         # Converting the input to String
         level_str = str(level)
         
-        command(self.port,":PULSE0:EXTernal:MODe TRIGger\n", repeat = True, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
-        command(self.port,":PULSE0:EXTernal:LEVel " + level_str + "\n", repeat = True, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
-        command(self.port,":PULSE0:EXTernal:EDGe " + edge + "\n", repeat = True, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
+        self._pipeline([":PULSE0:EXTernal:MODe TRIGger\n",
+                        ":PULSE0:EXTernal:LEVel " + level_str + "\n",
+                        ":PULSE0:EXTernal:EDGe " + edge + "\n"])
 
         return True 
 
@@ -474,26 +1001,86 @@ class BNC_505:
           enable (optional): If True the channel will be enabled, default to True
       
       RETURNS
-          None
+          True once all the settings are acknowledged, raises a RuntimeError with the failed commands otherwise
 
       """        
-      # Converting the imput to String
-      channel_str = str(channel)
-      delay_str = str(delay)
-      width_str = str(width)
-      amp_str = str(amp)
+      p = self._prefix[int(channel)] # Command prefix of the channel
       
-      command(self.port, ":PULSE" + channel_str + ":SYNC " + ref + "\n", repeat = True, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
-      command(self.port, ":PULSE" + channel_str + ":CMODE "+ cmode +"\n", repeat = True, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits) # Set to send a single pulse
-      command(self.port, ":PULSE" + channel_str + ":OUTPUT:AMPLITUDE " + amp_str + "V\n", repeat = True, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
-      command(self.port, ":PULSE" + channel_str + ":DELAY " + delay_str + "\n", repeat = True, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
-      command(self.port, ":PULSE" + channel_str + ":WIDTH " + width_str + "\n", repeat = True, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits)
+      self._pipeline([f"{p}:SYNC {ref}\n",
+                      f"{p}:CMODE {cmode}\n", # Set to send a single pulse
+                      f"{p}:OUTPUT:AMPLITUDE {amp}V\n",
+                      f"{p}:DELAY {delay}\n",
+                      f"{p}:WIDTH {width}\n"])
 
       return True
 
 #-----------------------------------------------------------------------------------------------------------------------------------------------------------------
 # Class definition and functions for Arduino Uno
+def _decode_timestamps(ts_words):
+    """
+    DESCRIPTION:
+        Decodes the 4 byte words sent by the TDC into the valid event times and their channel codes, the whole
+        decoding is done with array operations so there is no loop over the events
+        
+    PARAMETERS:
+        ts_words(array): uint32 array with the words sent by the TDC, in order
+        
+    RETURNS:
+        ts_list: int64 array with the times of the valid events in ns
+        
+        channels: uint8 array with the 4 bit channel code of each valid event
+    """
+    periode_duration = 1 << 27 # This is the length of 1 period (same as 2^27)
+    
+    time_stamps = (ts_words >> 5).astype(np.int64) # Removing the last five bits since they dont have
+                                                   # timestamp information (only dummy flag and detector pattern)
+    
+    patterns = (ts_words & 0x1F).astype(np.uint8) # This gets the last 5 bits of each word, that is, the dummy flag
+                                                  # and the detector pattern
+    
+    periode_count = np.cumsum(np.diff(time_stamps, prepend=time_stamps[:1]) < 0, dtype=np.int64)
+    # A timestamp smaller than the previous one means there was a rollover (restart the count), 
+    # so the running sum gives how many rollovers happend before each word
+    
+    valid = (patterns & 0x10) == 0 # The 5th bit (dummy flag) is zero when the timestamp is valid
+    
+    # This calculates the actual timestamp by adding the original value with the number of 
+    # periods (number of rollovers) * the duration of the period, the arrays are updated in place to avoid copies
+    periode_count *= periode_duration
+    time_stamps += periode_count
+    
+    ts_list = time_stamps[valid]
+    ts_list *= 2 # Each step is equivalent to 2ns
+    
+    channels = patterns[valid]
+    channels &= 0xF
+    
+    return ts_list, channels
+
+# Names of the columns of the channel mask returned by channel_cleaner, the channels of event i are CHANNEL_NAMES[np.nonzero(mask[i])[0]]
+CHANNEL_NAMES = np.array(['CH4', 'CH3', 'CH2', 'CH1'])
+
+@dataclass(slots=True)
+class TDCResult:
+    """
+    Results of one TDC shot, as returned by arduino_UNO.start
+    
+    CLASS ELEMENTS:
+        counts: int64 array with the event times in ns
+        
+        mask: (N, 4) uint8 channel mask of the events, the columns are CH4, CH3, CH2, CH1 (see CHANNEL_NAMES)
+        
+        ch_counts: tupple containing the number of counts each channel received (counts1, counts2, counts3, counts4)
+    """
+    counts: np.ndarray
+    mask: np.ndarray
+    ch_counts: tuple
+
 class arduino_UNO:    
+    _BIN4_LUT = np.array(["{0:04b}".format(i) for i in range(16)], dtype="<U4") # Binary string of each of the 16 possible channel patterns
+    _CH_SHIFTS = np.array([3, 2, 1, 0], dtype=np.uint8) # Bit of the code of CH4, CH3, CH2 and CH1
+    _UNIT_SCALE = {'us': 10**(-3), 'ms': 10**(-6), 's': 10**(-9)} # Factor to convert from nanoseconds to each unit
+    
     def __init__(self, port, baud_rate, bit_size, parity, stop_bits):
         """   
         class for arduino uno
@@ -517,75 +1104,97 @@ class arduino_UNO:
             stop_bits: Stopbits, need to use the serial library variables
                                 accepts: 
                                     serial.STOPBITS_ONE, serial.STOPBITS_ONE_POINT_FIVE, serial.STOPBITS_TWO
+            
+            uno: serial connection to the Uno, opened when the class is created and kept open until close
         """
         self.port = port
         self.baud_rate = baud_rate
         self.parity = parity
         self.stop_bits = stop_bits
         self.bit_size = bit_size
+        self._serial_kwargs = dict(brate = baud_rate, bsize = bit_size, par = parity, stopb = stop_bits) # Arguments of every command call
+        self.uno = None
+        self.open() # The port stays open for every shot, use the class in a with-block to close it at the end
+    
+    def open(self):
+        """
+        DESCRIPTION:
+            Opens the serial connection to the Uno, which is then reused by every call to start
+            
+        PARAMETERS:
+            None
+            
+        RETURNS:
+            None
+        """
+        self.uno = get_device(self.port, **self._serial_kwargs, inter_byte_timeout = None)
+        try:
+            self.uno.set_low_latency_mode(True) # Only available on Linux, makes the driver deliver the bytes without buffering delay
+        except (AttributeError, ValueError, OSError):
+            pass
     
-    def read_timestamps(self, binary_stream, legacy = True):
+    def close(self):
+        """
+        DESCRIPTION:
+            Closes the serial connection to the Uno
+            
+        PARAMETERS:
+            None
+            
+        RETURNS:
+            None
+        """
+        if self.uno is None:
+            return
+        with _CACHE_LOCK:
+            with _PORT_LOCKS[self.port]:
+                self.uno.close()
+            if _PORT_CACHE.get(self.port) is self.uno:
+                del _PORT_CACHE[self.port]
+        self.uno = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def read_timestamps(self, binary_stream, legacy = False):
         """
         (Modified from S15lib.instruments)
         DESCRIPTION:
-            Reads the timestamps accumulated in a binary sequence and returns a
-            Tuple[List[float], List[str]]: with the event times in ns and the 
-            corresponding event channel. The channel are returned as string where
-            a 1 indicates the trigger channel. For example an event in channel 2
-            would correspond to "0010". Two coinciding events in channel 3 and 4
-            correspond to "1100".
+            Reads the timestamps accumulated in a binary sequence and returns two
+            arrays of the same length: the event times in ns (int64) and the 
+            corresponding event channel code (uint8). Bit k of the code is set when 
+            channel k+1 received the signal, for example an event in channel 2 has 
+            the code 2 (0b0010) and two coinciding events in channel 3 and 4 have
+            the code 12 (0b1100).
+            The arrays are kept separate so that selecting the events of a channel only 
+            reads the codes, e.g. ts_list[(event_channel_list & 0b0010) != 0] for channel 2.
         
         PARAMETERS:
             binary_stream: binary input to be read
             
+            legacy (optional): If True the channels are returned as 4 digit strings ("0010", "1100", ...), otherwise as 
+                                the integer codes. Deprecated, the strings are only kept for old scripts, default to False
+            
         RETURNS
-            ts_list: list containing the timestamps at which signals were received
-            event_channel_list: list containing the respective channels which received the signals
+            ts_list: int64 array containing the timestamps at which signals were received
+            event_channel_list: uint8 array containing the code of the respective channels which received the signals
         """
         # Changing the input
-        bytes_hex = binary_stream[::-1].hex() # reverts the stream and converts is to hexadecimal
-        ts_word_list = [    
-            int(bytes_hex[i : i + 8], 16) for i in range(0, len(bytes_hex), 8)
-            ][::-1] # Truncates the initial stream into packages of two 8-character "words" and 
-                    # converts to integers and reverses back to the order from before
-
-        # Initializing variables
-        ts_list = []
-        event_channel_list = []
-        periode_count = 0 # How many rollovers (count restart) happend so far
-        periode_duration = 1 << 27 # This is the length of 1 period (same as 2^27)
-        prev_ts = -1 # means that no other timestamp was analysed yet
-        
-        # Iterating for each "words"
-        for ts_word in ts_word_list:
-            time_stamp = ts_word >> 5 # Removing the last five charachters since they dont have
-                                      # timestamp information (only dummy flag and detector pattern)
-                                      
-            pattern = ts_word & 0x1F # This gets the last 5 bits of the word, that is, the dummy flag
-                                     # and the detector pattern
-            
-            if prev_ts != -1 and time_stamp < prev_ts: # Checks if the new timestamp is  smaller than the 
-                                                       # previous one (), which would happend if there is a
-                                                       # rollover (restart the count)
-                periode_count += 1 # increase the period count to use it latter
-            
-            prev_ts = time_stamp # sets the previous timestamp to compare with the next one
-            
-            if (pattern & 0x10) == 0: # Check if the 5 last bit (dummy flag) of the word is zero which indicates that the timestamp is valid.
-                                     
-                ts_list.append(time_stamp + periode_duration * periode_count)
-                # This calculates the actual timestamp by adding the original value with the number of 
-                # periods (number of rollovers) * the duration of the period and appends it to a list
-                
-                if legacy:
-                    # Save the channels as a binary string
-                    event_channel_list.append("{0:04b}".format(pattern & 0xF))
-                else:
-                    # Save the channels as integers
-                    event_channel_list.append(pattern & 0xF)
-        ts_list = np.array(ts_list, dtype="int64") * 2  # Each step is equivalent to 2ns
-        if not legacy:
-            event_channel_list = np.array(event_channel_list)
+        ts_words = np.frombuffer(binary_stream, dtype="<u4", offset=len(binary_stream) % 4)
+        # Reads the stream as little-endian 4 byte "words", the words are aligned to the end of the
+        # stream so any incomplete word at the start is skipped
+
+        ts_list, channels = _decode_timestamps(ts_words)
+        
+        if legacy:
+            # Converting the channels to binary strings, only when asked for
+            event_channel_list = self._BIN4_LUT[channels]
+        else:
+            # Save the channels as integers
+            event_channel_list = channels
         return ts_list, event_channel_list
     
     def convert_units(self, counts_ns, units = 'ns'):
@@ -603,66 +1212,43 @@ class arduino_UNO:
         RETURNS
             counts_converted: array of counts in the specified units
         """
-        counts_ns = np.array(counts_ns) # Changing to an Array 
+        counts_ns = np.asarray(counts_ns) # Changing to an Array, without copying if it already is one
         
         # Selecting the Units
         if units == 'ns':
-            counts_converted = counts_ns
-        
-        elif units == 'us':
-            counts_converted = counts_ns * 10**(-3)
+            return counts_ns
         
-        elif units == 'ms':
-            counts_converted = counts_ns * 10**(-6)
-        
-        elif units == 's':
-            counts_converted = counts_ns * 10**(-9)
+        counts_converted = counts_ns * self._UNIT_SCALE[units]
             
         return counts_converted
     
     def channel_cleaner(self, cha_info):
         """
         DESCRIPTION:
-            takes an array of 4 digit code for channels sending the pulse and returns the 
-            channels that sent the triggers
+            takes an array of 4 digit code for channels sending the pulse and returns a mask 
+            of the channels that sent the triggers
         
         PARAMETERS:
-            cha_info(array): Array containg the code for the channels [   xxxx xxxx xxxx xxxx ...] 
+            cha_info(array): Array containg the integer code for the channels, as returned by read_timestamps with legacy = False,
+                                the 4 digit strings [   xxxx xxxx xxxx xxxx ...] are also accepted
             
         RETURNS
-            cha_clean: List of the channels received in order correspondent to the counts
+            mask: (N, 4) uint8 array with one row per event in order correspondent to the counts, the columns are 
+                    CH4, CH3, CH2, CH1 (see CHANNEL_NAMES) and are 1 when the channel received the signal
             
             (counts1, ...): tupple containing the number of counts each channel received
         """
+        patterns = np.asarray(cha_info)
+        if patterns.dtype.kind == "U": # Converting the legacy 4 digit strings to integers
+            patterns = np.array([int(cha_list, 2) for cha_list in patterns.tolist()])
+        patterns = patterns.astype(np.uint8, copy=False)
         
-        cha_clean = []
-        counts_1 = 0
-        counts_2 = 0
-        counts_3 = 0
-        counts_4 = 0
+        # Bit k of the code is set when channel k+1 received the signal, this gives a matrix with one row per event
+        # and one column per channel (CH4, CH3, CH2, CH1)
+        mask = (patterns[:, None] >> self._CH_SHIFTS) & 1
+        counts_4, counts_3, counts_2, counts_1 = mask.sum(axis=0).tolist()
         
-        # Converting from the 4 digits to channels
-        for cha_list in cha_info: 
-            channel = []
-            if cha_list[0] == '1':
-                channel.append('CH4')
-                counts_4 += 1
-    
-            if cha_list[1] == '1':
-                channel.append('CH3')
-                counts_3 += 1
-                
-            if cha_list[2] == '1':
-                channel.append('CH2')
-                counts_2 += 1
-    
-            if cha_list[3] == '1':
-                channel.append('CH1')
-                counts_1 += 1
-    
-            cha_clean.append(channel)
-        
-        return cha_clean, (counts_1, counts_2, counts_3, counts_4)
+        return mask, (counts_1, counts_2, counts_3, counts_4)
         
     def start(self):
         """
@@ -678,43 +1264,99 @@ class arduino_UNO:
             None
             
         RETURNS:
-            results from TDC
+            TDCResult with the event times in ns, the (N, 4) channel mask and the counts of each channel
         """
-        with initialize_device(self.port, brate = self.baud_rate, bsize = self.bit_size, par = self.parity, stopb = self.stop_bits) as UNO:
+        if self.uno is None or not self.uno.is_open: # Reopening if the port was closed (e.g. by close_all)
+            self.open()
+        UNO = self.uno
+        
+        # The command is only sent again after a long silence, the Uno resets when its port is opened and takes 1-2s 
+        # to boot, and every start which reaches it fires a shot (prepulse and shutter). The TDC results are also a long 
+        # binary line which must not be cut. The timeout of the shared port is set back at the end
+        with _PORT_LOCKS[self.port], _read_timeout(UNO, [], 1.5):
+            
+            UNO.reset_input_buffer() # The port stays open between shots, discarding what is left from the previous one
             
             first_com = b""
+            while first_com != _START_CMD:
+                if first_com == b"": # Nothing was received, (re)sending the command
+                    UNO.write(_START_CMD)
+                    UNO.flush()
+                first_com = UNO.read_until(b"\n") # Returns as soon as the answer arrives
+            
             while True:
-                while first_com != b"start\n":
-                    UNO.write(str.encode("start\n"))
-                    time.sleep(0.1)
-                    first_com = UNO.readline()
-
-                
-                
                 #print(first_com)
                 hex_stream = UNO.readline()
-                [counts, cha_info] = self.read_timestamps(hex_stream)
 
-                if hex_stream != b'' and hex_stream != b"start" and hex_stream != b'\r\n'  and hex_stream != b"a":
+                if hex_stream not in _SKIP:
+                    [counts, cha_info] = self.read_timestamps(hex_stream) # Only decoding the line holding the results
                     counts = self.convert_units(counts, 'ns')
-                    channels, ch_counts = self.channel_cleaner(cha_info)
-                    return counts, channels, ch_counts
-                    
-                    break
-            pass
+                    mask, ch_counts = self.channel_cleaner(cha_info)
+                    return TDCResult(counts, mask, ch_counts)
         
         
 #-----------------------------------------------------------------------------------------------------------------------------------------------------------------
 # Class definition and functions for Camera        
+
+# The dll path only has to be added once per process, otherwise PATH keeps growing with every call
+_dlls_configured = False
+
 class thor_camera:
     def __init__(self):
         """
         class for thorlabs compact scientific camera model CS505MU1 
         
         CLASS ELEMENTS:
+            _save_q - queue of (file_path, image) pairs waiting to be written to disk
+            _saver - background thread writing the queued images
+            _save_errors - (file_path, exception) pairs of the images which could not be saved, raised by flush
+            sdk - TLCameraSDK instance, opened by arm_camera
+            camera - opened camera, set by arm_camera
+        """
+        self.sdk = None
+        self.camera = None
+        self._save_q = queue.Queue()
+        self._save_errors = []
+        self._saver = threading.Thread(target=self._save_loop, daemon=True)
+        self._saver.start()
+    
+    def _save_loop(self):
+        """
+        DESCRIPTION:
+            Runs in the background thread, saving each queued image so the network drive write does not hold up the next shot
+        
+        PARAMETERS:
+            None
+        
+        RETURNS:
+            None
+        """
+        while True:
+            file_path, image = self._save_q.get()
+            try:
+                np.save(file_path, image)
+            except Exception as e:
+                print(f"Error saving {file_path}: {e}")
+                self._save_errors.append((file_path, e)) # Kept to be raised by flush
+            finally:
+                self._save_q.task_done()
+    
+    def flush(self):
+        """
+        DESCRIPTION:
+            Blocks until every image handed to get_image has been written to disk
+        
+        PARAMETERS:
             None
+        
+        RETURNS:
+            None, raises a RuntimeError with the images which could not be saved since the last flush
         """
-        pass
+        self._save_q.join()
+        
+        errors, self._save_errors = self._save_errors, []
+        if errors:
+            raise RuntimeError("Saving images failed: " + ", ".join(f"{file_path} -> {e}" for file_path, e in errors)) from errors[0][1]
     
     def windows_set_up(self):
         """
@@ -728,6 +1370,11 @@ class thor_camera:
         RETURNS:
             None
         """
+        global _dlls_configured
+        if _dlls_configured:
+            return
+        _dlls_configured = True
+        
         try:
             is_64bits = sys.maxsize > 2**32
             relative_path_to_dlls = '.' + os.sep + 'dlls' + os.sep
@@ -787,22 +1434,21 @@ class thor_camera:
         RETURNS:
             None
         """
-        global sdk, available_cameras, camera
         self.windows_set_up()
         
-        sdk = TLCameraSDK()
-        available_cameras = sdk.discover_available_cameras()
+        self.sdk = TLCameraSDK()
+        available_cameras = self.sdk.discover_available_cameras()
         if len(available_cameras) < 1:
             print("no cameras detected")
         
-        camera = sdk.open_camera(available_cameras[0])
-        camera.arm(2)
+        self.camera = self.sdk.open_camera(available_cameras[0])
+        self.camera.arm(2)
         
     def get_image(self, filename):
         """
         DESCRIPTION: 
             When run with hardware trigger parameters will continue to run until hardware trigger is recieved and photo is taken. The Image
-            is saved in the image folder with the name "filename.npy"
+            is saved in the image folder with the name "filename.npy" by the background saver, call flush() to wait for it
         
         PARAMETERS:
             filename: name of the file to be saved
@@ -810,27 +1456,22 @@ class thor_camera:
         RETURNS:
             None
         """
-        global sdk, available_cameras, camera
-        
+        camera = self.camera
         frame = camera.get_pending_frame_or_null()
 
         if frame is not None:
             #print("frame #{} received!".format(frame.frame_count))
-            frame.image_buffer
-            image_buffer_copy = np.copy(frame.image_buffer)
-            numpy_shaped_image = image_buffer_copy.reshape(camera.image_height_pixels, camera.image_width_pixels)
-            nd_image_array = np.full((camera.image_height_pixels, camera.image_width_pixels, 3), 0, dtype=np.uint8)
-            nd_image_array[:,:,0] = numpy_shaped_image
-            nd_image_array[:,:,1] = numpy_shaped_image
-            nd_image_array[:,:,2] = numpy_shaped_image
+            # reshape the SDK buffer in place, the uint8 conversion below is the only copy made
+            numpy_shaped_image = np.asarray(frame.image_buffer).reshape(camera.image_height_pixels, camera.image_width_pixels)
+            # greyscale frame, so view it as 3 identical channels rather than copying it three times
+            nd_image_array = np.broadcast_to(numpy_shaped_image.astype(np.uint8)[..., None], (camera.image_height_pixels, camera.image_width_pixels, 3))
+
+            save_dir = "Z:/Users/coop/Chloe_Enzo_2024/Images"
+            file_path = os.path.join(save_dir, filename)
+            self._save_q.put((file_path, nd_image_array))
         else:
             print("No frame detected")
         camera.disarm()
-        # Because we are using the 'with' statement context-manager, disposal has been taken care of.
-        save_dir = "Z:/Users/coop/Chloe_Enzo_2024/Images"
-        file_path = os.path.join(save_dir, filename)
-
-        np.save(file_path, nd_image_array)
         return 
     
     def close_camera(self):
@@ -842,11 +1483,15 @@ class thor_camera:
             None
             
         RETURNS:
-            None
+            None, raises a RuntimeError if any image could not be saved (the camera is disposed anyway)
         """
-        global sdk, available_cameras, camera
-        camera.dispose()
-        sdk.dispose()
+        try:
+            self.flush()
+        finally:
+            self.camera.dispose()
+            self.sdk.dispose()
+            self.camera = None
+            self.sdk = None
 
         
 #-----------------------------------------------------------------------------------------------------------------------------------------------------------------
@@ -861,9 +1506,33 @@ class oscilloscope:
         class for Tektronix TDS 2014C oscilloscope 
         
         CLASS ELEMENTS:
+            scope: pyvisa resource of the oscilloscope, opened once and reused by every function
+        """
+        self.scope = None
+        try:
+            self.scope = rm.open_resource('USB::0x0699::0x03A4::C015987::INSTR', send_end=True)
+            self.scope.timeout = 2000 # ms, a lost answer raises an error instead of hanging forever
+            self.scope.query_delay = 0.0 # The answer is read as soon as the query is written
+            self.scope.chunk_size = 20*1024
+            self.scope.write_termination = '\n' # The TDS 2014C terminates its messages with a new line
+            self.scope.read_termination = '\n'
+        except pyvisa.Error as e:
+            print(f'Error opening oscilloscope: {str(e)}')
+    
+    def close(self):
+        """
+        DESCRIPTION:
+            Closes the connection to the oscilloscope
+            
+        PARAMETERS:
+            None
+            
+        RETURNS:
             None
         """
-        pass
+        if self.scope is not None:
+            self.scope.close()
+            self.scope = None
     
     def ready(self):
         """
@@ -876,14 +1545,8 @@ class oscilloscope:
         RETURNS:
             None
         """
-        try:
-            scope = rm.open_resource('USB::0x0699::0x03A4::C015987::INSTR', send_end=True)
-            scope.timeout = None
-        except pyvisa.Error as e:
-            print(f'Error opening oscilloscope: {str(e)}')
-            
-        scope.write("ACQuire:STATE RUN")   
-        scope.write("ACQuire:STOPAfter SEQuence")
+        self.scope.write("ACQuire:STATE RUN")   
+        self.scope.write("ACQuire:STOPAfter SEQuence")
          
           
         
@@ -908,14 +1571,8 @@ class oscilloscope:
         meas_num_str = str(meas_num)
         meas_source_str = str(meas_source)
         
-        try:
-            scope = rm.open_resource('USB::0x0699::0x03A4::C015987::INSTR', send_end=True)
-            scope.timeout = None
-        except pyvisa.Error as e:
-            print(f'Error opening oscilloscope: {str(e)}')
-        
-        scope.write("MEASUrement:MEAS"+ meas_num_str + ":SOUrce CH" + meas_source_str)
-        scope.write("MEASUrement:MEAS"+ meas_num_str + ":TYPE " + meas_type)
+        self.scope.write("MEASUrement:MEAS"+ meas_num_str + ":SOUrce CH" + meas_source_str)
+        self.scope.write("MEASUrement:MEAS"+ meas_num_str + ":TYPE " + meas_type)
         
     
     def save(self, mem = 1):
@@ -929,14 +1586,8 @@ class oscilloscope:
         RERTURN:
             None
         """
-        try:
-            scope = rm.open_resource('USB::0x0699::0x03A4::C015987::INSTR', send_end=True)
-            scope.timeout = None
-        except pyvisa.Error as e:
-            print(f'Error opening oscilloscope: {str(e)}')
-            
         mem_str = str(mem) 
-        scope.write("SAVE:SETUP " + mem_str)  
+        self.scope.write("SAVE:SETUP " + mem_str)  
         
         return 
         
@@ -951,14 +1602,8 @@ class oscilloscope:
         RERTURN:
             None
         """
-        try:
-            scope = rm.open_resource('USB::0x0699::0x03A4::C015987::INSTR', send_end=True)
-            scope.timeout = None
-        except pyvisa.Error as e:
-            print(f'Error opening oscilloscope: {str(e)}')
-            
         mem_str = str(mem) 
-        scope.write("RECALL:SETUP " + mem_str)            
+        self.scope.write("RECALL:SETUP " + mem_str)            
 
         
     def get_value(self, meas_num):
@@ -975,13 +1620,7 @@ class oscilloscope:
         """
         meas_num_str = str(meas_num)
         
-        try:
-            scope = rm.open_resource('USB::0x0699::0x03A4::C015987::INSTR', send_end=True)
-            scope.timeout = None
-        except pyvisa.Error as e:
-            print(f'Error opening oscilloscope: {str(e)}')
-            
-        voltage = float(scope.query("MEASUrement:MEAS" + meas_num_str + ":VALue?"))
+        voltage = float(self.scope.query("MEASUrement:MEAS" + meas_num_str + ":VALue?"))
         return voltage
         
 #-----------------------------------------------------------------------------------------------------------------------------------------------------------------
@@ -1008,10 +1647,25 @@ class stepper_motor:
         self.parity = parity
         self.stop_bits = stop_bits
         self.bit_size = bit_size
+        self._serial_kwargs = dict(brate = baud_rate, bsize = bit_size, par = parity, stopb = stop_bits, eol = b"\r") # Arguments of every command call, the SMD2 responses end in "\r"
         self.b1_flag = False
         self.b2_flag = False
         self.end = False
     
+    def _pipeline(self, cmds):
+        """
+        DESCRIPTION:
+            Sends a list of commands to the motor driver in a single write (e.g. selecting the motor and moving it)
+            
+        PARAMETERS:
+            cmds(list of str): commands to be sent, in order
+        
+        RETURNS:
+            responses: list with the response from the device to each command
+        """
+        responses = pipeline(self.port, cmds, **self._serial_kwargs)
+        return responses
+    
     def back(self, steps):
         """
         DESCRIPTION:
@@ -1026,8 +1680,7 @@ class stepper_motor:
         
         steps_str = str(steps)
         
-        command(self.port, "B1 \r", self.baud_rate, self.bit_size, self.parity, self.stop_bits)
-        res = command(self.port, "-" + steps_str + "\r", self.baud_rate, self.bit_size, self.parity, self.stop_bits)
+        res = self._pipeline(["B1 \r", "-" + steps_str + "\r"])[-1] # Selecting the motor and moving in one write
         self.wait()
         
         return res
@@ -1046,8 +1699,7 @@ class stepper_motor:
         
         steps_str = str(steps)
         
-        command(self.port, "B1 \r", self.baud_rate, self.bit_size, self.parity, self.stop_bits)
-        res = command(self.port, "+" + steps_str + "\r", self.baud_rate, self.bit_size, self.parity, self.stop_bits)
+        res = self._pipeline(["B1 \r", "+" + steps_str + "\r"])[-1] # Selecting the motor and moving in one write
         self.wait()
         return res
     
@@ -1064,8 +1716,7 @@ class stepper_motor:
         """
         steps_str = str(steps)
         
-        command(self.port, "B2 \r", self.baud_rate, self.bit_size, self.parity, self.stop_bits)
-        res = command(self.port, "-" + steps_str + "\r", self.baud_rate, self.bit_size, self.parity, self.stop_bits)
+        res = self._pipeline(["B2 \r", "-" + steps_str + "\r"])[-1] # Selecting the motor and moving in one write
         self.wait()
         return res
         
@@ -1082,8 +1733,7 @@ class stepper_motor:
         """        
         steps_str = str(steps)
         
-        command(self.port, "B2 \r", self.baud_rate, self.bit_size, self.parity, self.stop_bits)
-        res = command(self.port, "+" + steps_str + "\r", self.baud_rate, self.bit_size, self.parity, self.stop_bits)
+        res = self._pipeline(["B2 \r", "+" + steps_str + "\r"])[-1] # Selecting the motor and moving in one write
         self.wait()
         return res
     
@@ -1110,13 +1760,8 @@ class stepper_motor:
         RETURNS:
             None
         """
-        command(self.port, "B2 \r", self.baud_rate, self.bit_size, self.parity, self.stop_bits)
-        
-        
         # Getting the position in integers
-        position1 = int(bytes.decode(command(self.port,"V1 \r", self.baud_rate, self.bit_size, self.parity, self.stop_bits))[2:-1])
-        
-
+        position1 = int(bytes.decode(self._pipeline(["B2 \r", "V1 \r"])[-1])[2:-1])
         
         if position1 >= size and not self.b1_flag: # If @ end of line and not at end of pattern will move forwards to the next line 
             self.forward(steps)
@@ -1137,11 +1782,47 @@ class stepper_motor:
             self.b1_flag = False
             
         # Getting the position
-        command(self.port, "B1 \r", self.baud_rate, self.bit_size, self.parity, self.stop_bits)
-        position2 = int(bytes.decode(command(self.port,"V1 \r", self.baud_rate, self.bit_size, self.parity, self.stop_bits))[2:-1])
+        position2 = int(bytes.decode(self._pipeline(["B1 \r", "V1 \r"])[-1])[2:-1])
         if position2 >= size:
             self.end = True
 
+    def raster(self, rows, cols, step):
+        """
+        DESCRIPTION:
+            Scans the stage over the same snake pattern as new_position starting from (0,0): one forward move to the next line 
+            followed by the whole line done as a single long move of (cols - 1) * step steps, so the motor is only polled at the 
+            ends of each line instead of at every point. The stage does not stop at the points along a line, so use new_position 
+            when a shot has to be taken at each point. The flags of new_position are updated as after moving along a line 
+            and end is set once the pattern is done, unlike new_position no last forward move is made after the last line.
+            
+        PARAMETERS:
+            rows: number of lines in the pattern, e.g. 4 lines 500 steps apart cover the same lines (500 to 2000 steps) as new_position(500, 2500)
+            
+            cols: number of points in each line, e.g. 6 points 500 steps apart cover the same 0 to 2500 steps as new_position(500, 2500)
+            
+            step: number of steps between two points
+        
+        RETURNS:
+            None
+        """
+        line_str = str((cols - 1) * step) # cols points are joined by cols - 1 steps
+        step_str = str(step)
+        
+        for row in range(rows):
+            # Moving forward to the next line, new_position also does this first when starting at the end of a line
+            self._pipeline(["B1 \r", "+" + step_str + "\r"])
+            self.wait()
+            
+            direction = "+" if row % 2 == 0 else "-" # The first line goes left like new_position, then it alternates
+            self._pipeline(["B2 \r", direction + line_str + "\r"])
+            self.wait()
+            
+            # Same flags as new_position after moving along a line
+            self.b1_flag = False
+            self.b2_flag = direction == "-"
+        
+        self.end = True
+
     def set_home(self):
         """
         DESCRIPTION:
@@ -1150,7 +1831,7 @@ class stepper_motor:
         PARAMETERS:
             None
         """
-        command(self.port, "I3 \r"  , self.baud_rate, self.bit_size, self.parity, self.stop_bits)
+        command(self.port, "I3 \r"  , **self._serial_kwargs)
 
     def go_home(self):
         """
@@ -1161,11 +1842,9 @@ class stepper_motor:
             None
         """
         
-        command(self.port, "B1 \r", self.baud_rate, self.bit_size, self.parity, self.stop_bits)
-        command(self.port, "G+0 \r"  , self.baud_rate, self.bit_size, self.parity, self.stop_bits)
+        self._pipeline(["B1 \r", "G+0 \r"])
         self.wait()
-        command(self.port, "B2 \r", self.baud_rate, self.bit_size, self.parity, self.stop_bits)
-        command(self.port, "G+0 \r"  , self.baud_rate, self.bit_size, self.parity, self.stop_bits)
+        self._pipeline(["B2 \r", "G+0 \r"])
         self.wait()
         
         return 
@@ -1181,7 +1860,7 @@ class stepper_motor:
         RETURNS:
             None
         """
-        res = command(self.port, "F \r", self.baud_rate, self.bit_size, self.parity, self.stop_bits)
+        res = command(self.port, "F \r", **self._serial_kwargs)
         return res
 
     def wait(self):
@@ -1195,9 +1874,10 @@ class stepper_motor:
         RETURNS:
             None
         """        
+        delay = 0.002 # Short moves are detected after a few ms, long moves are polled less often
         while self.is_moving() != b'Y\r':
-            time.sleep(0.1)
-            continue
+            time.sleep(delay)
+            delay = min(delay * 1.5, 0.05)
         
     def position(self, x,y):
         """
@@ -1214,11 +1894,9 @@ class stepper_motor:
         x_com = "G" + str(x) +" \r"
         y_com = "G" + str(y) +" \r"
         
-        command(self.port, "B2 \r", self.baud_rate, self.bit_size, self.parity, self.stop_bits)
-        command(self.port, x_com  , self.baud_rate, self.bit_size, self.parity, self.stop_bits)
+        self._pipeline(["B2 \r", x_com])
         self.wait()
-        command(self.port, "B1 \r", self.baud_rate, self.bit_size, self.parity, self.stop_bits)
-        command(self.port, y_com  , self.baud_rate, self.bit_size, self.parity, self.stop_bits)
+        self._pipeline(["B1 \r", y_com])
         self.wait()
         
         return 